@@ -1,30 +1,556 @@
+import os
 import sys
 import time
+import queue
 import nplab
+import logging
+import threading
 import traceback
+import numpy as np
+import pyqtgraph as pg
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from nplab.experiment import Experiment, ExperimentStopped
 from nplab.instrument.stage.Marzhauser.tango import Tango, translate_axis
 from nplab.instrument.camera.lumenera import LumeneraCamera
 from nplab.instrument.camera.camera_with_location import CameraWithLocation
 from nplab.instrument.spectrometer.seabreeze import OceanOpticsSpectrometer
 from nplab.utils.notified_property import DumbNotifiedProperty
+from nplab.utils.array_with_attrs import ArrayWithAttrs
 from nplab.ui.ui_tools import UiTools, QuickControlBox
-from nplab.utils.gui import QtWidgets, get_qt_app, uic
+from nplab.utils.gui import QtCore, QtWidgets, get_qt_app, uic
+
+
+def to_grayscale(image, roi_fraction=1.0, downsample=1):
+    """Return a float32 grayscale copy of the central ROI of image, binned by downsample"""
+    image = np.asarray(image)
+    height, width = image.shape[:2]
+    roi_height, roi_width = int(height * roi_fraction), int(width * roi_fraction)
+    roi_height -= roi_height % downsample
+    roi_width -= roi_width % downsample
+    top, left = (height - roi_height) // 2, (width - roi_width) // 2
+    roi = image[top:top + roi_height, left:left + roi_width].astype(np.float32)
+    if roi.ndim == 3:
+        roi = roi.mean(axis=2)
+    if downsample > 1:
+        roi = roi.reshape(roi_height // downsample, downsample,
+                          roi_width // downsample, downsample).mean(axis=(1, 3))
+    return roi
+
+
+def estimate_shift(reference, image):
+    """Estimate the (row, column) shift of image relative to reference
+
+    Uses phase correlation, so both must be 2D arrays of the same shape.
+    Returns the sub-pixel shift and the height of the correlation peak, which
+    is close to 1 for a clean match and close to 0 when nothing matched.
+    """
+    window = np.outer(np.hanning(reference.shape[0]), np.hanning(reference.shape[1]))
+    reference_fft = np.fft.rfft2((reference - reference.mean()) * window)
+    image_fft = np.fft.rfft2((image - image.mean()) * window)
+    cross_power = image_fft * np.conj(reference_fft)
+    cross_power /= np.abs(cross_power) + 1e-12
+    correlation = np.fft.irfft2(cross_power, s=reference.shape)
+
+    peak = np.unravel_index(np.argmax(correlation), correlation.shape)
+    shift = np.array(peak, dtype=float)
+    for axis, size in enumerate(correlation.shape):
+        # Parabolic fit through the peak and its neighbours for sub-pixel accuracy
+        before, after = list(peak), list(peak)
+        before[axis] = (peak[axis] - 1) % size
+        after[axis] = (peak[axis] + 1) % size
+        y0, y1, y2 = correlation[tuple(before)], correlation[peak], correlation[tuple(after)]
+        denominator = y0 - 2 * y1 + y2
+        if denominator != 0:
+            shift[axis] += 0.5 * (y0 - y2) / denominator
+        if shift[axis] > size / 2:  # Shifts past halfway wrap round to negative
+            shift[axis] -= size
+    return shift, correlation[peak]
+
+
+def box_blur(image, size):
+    """Mean over a size x size window (size odd), using cumulative sums"""
+    radius = size // 2
+    for axis in (0, 1):
+        padding = [(0, 0)] * image.ndim
+        padding[axis] = (radius + 1, radius)
+        summed = np.cumsum(np.pad(image, padding, mode='edge'), axis=axis)
+        upper = np.take(summed, np.arange(size, summed.shape[axis]), axis=axis)
+        lower = np.take(summed, np.arange(summed.shape[axis] - size), axis=axis)
+        image = (upper - lower) / size
+    return image
+
+
+def local_sharpness(image, window=9):
+    """Squared Laplacian of a grayscale image, averaged over a window round each pixel"""
+    laplacian = np.zeros_like(image)
+    laplacian[1:-1, 1:-1] = (image[:-2, 1:-1] + image[2:, 1:-1] + image[1:-1, :-2]
+                             + image[1:-1, 2:] - 4 * image[1:-1, 1:-1])
+    return box_blur(laplacian ** 2, window)
+
+
+def fuse_stack(stack, window=9):
+    """Fuse a z-stack into an extended-depth-of-field image and a depth map
+
+    Each output pixel comes from the plane that is locally sharpest there. The
+    depth map holds that plane's index. This runs in a worker process, so it
+    must stay a module-level function.
+    """
+    stack = np.asarray(stack)
+    sharpness = np.stack([local_sharpness(to_grayscale(plane), window) for plane in stack])
+    depth = sharpness.argmax(axis=0)
+    indices = depth.reshape((1,) + depth.shape + (1,) * (stack.ndim - 3))
+    fused = np.take_along_axis(stack, indices, axis=0)[0]
+    return fused, depth.astype(np.uint8)
+
+
+def downsample_2x(image):
+    """Halve an image's height and width by averaging 2x2 blocks"""
+    image = np.asarray(image)
+    height, width = image.shape[0] // 2, image.shape[1] // 2
+    blocks = image[:2 * height, :2 * width].reshape((height, 2, width, 2) + image.shape[2:])
+    return blocks.mean(axis=(1, 3), dtype=np.float32).astype(image.dtype)
+
+
+def build_pyramid(image, thumbnail_size=128):
+    """Return image and successively halved copies of it
+
+    levels[n] is image downsampled by 2**n. The last level is the first whose
+    longest side is no more than thumbnail_size, and serves as the thumbnail,
+    so it's image itself if that's small enough already.
+    """
+    levels = [np.asarray(image)]
+    while max(levels[-1].shape[:2]) > thumbnail_size:
+        levels.append(downsample_2x(levels[-1]))
+    return levels
+
+
+def spectral_distance(previous, current):
+    """Relative L2 distance between two spectra"""
+    previous = np.asarray(previous, dtype=float).ravel()
+    current = np.asarray(current, dtype=float).ravel()
+    return np.linalg.norm(current - previous) / (np.linalg.norm(previous) + 1e-12)
+
+
+def frame_difference(previous, current):
+    """Mean absolute difference between two grayscale frames, relative to the previous mean"""
+    return np.abs(current - previous).mean() / (np.abs(previous).mean() + 1e-12)
+
+
+def next_interval(interval, change, threshold, min_interval, max_interval):
+    """Halve the interval when things change quickly, stretch it when they're steady"""
+    if change > threshold:
+        interval /= 2
+    elif change < threshold / 4:
+        interval *= 1.5
+    return min(max(interval, min_interval), max_interval)
+
+
+class ColourCalibration:
+    """Dark and flat-field references, and the correction derived from them
+
+    A corrected frame is (frame - dark) * gain. The per-pixel gain flattens
+    uneven illumination and balances the channels, so the flat reference
+    comes out an even neutral grey. Without flat-fielding, only the mean dark
+    level and a gain per channel are applied, through lookup tables.
+    """
+    def __init__(self, dark, flat):
+        self.dark = np.asarray(dark, dtype=np.float32)
+        self.flat = np.asarray(flat, dtype=np.float32)
+        channels = self.dark.shape[-1] if self.dark.ndim == 3 else 1
+        signal = np.maximum(self.flat - self.dark, 1e-3)
+        channel_means = signal.reshape(-1, channels).mean(axis=0)
+        target = channel_means.mean()
+        self.gain = (target / signal).astype(np.float32)
+        self.channel_gains = (target / channel_means).astype(np.float32)
+        self.channel_darks = self.dark.reshape(-1, channels).mean(axis=0)
+        self._lookup_tables = {}
+
+    def apply(self, frame, flat_field=True):
+        """Return a corrected copy of frame, with the same dtype"""
+        frame = np.asarray(frame)
+        if frame.shape != self.dark.shape:
+            raise ValueError(f'Frame shape {frame.shape} does not match '
+                             f'calibration shape {self.dark.shape}')
+        if not flat_field and frame.dtype.kind == 'u' and frame.dtype.itemsize <= 2:
+            tables = self.lookup_tables(frame.dtype)
+            if frame.ndim == 3:
+                return tables[np.arange(frame.shape[-1]), frame]
+            return tables[0][frame]
+        if flat_field:
+            corrected = (frame - self.dark) * self.gain
+        else:
+            corrected = (frame - self.channel_darks) * self.channel_gains
+        if frame.dtype.kind in 'ui':
+            limits = np.iinfo(frame.dtype)
+            corrected = np.clip(np.rint(corrected), limits.min, limits.max)
+        return corrected.astype(frame.dtype)
+
+    def lookup_tables(self, dtype):
+        """One table per channel mapping every raw value to its corrected value"""
+        dtype = np.dtype(dtype)
+        if dtype not in self._lookup_tables:
+            limits = np.iinfo(dtype)
+            values = np.arange(limits.max + 1, dtype=np.float32)
+            tables = (values[None, :] - self.channel_darks[:, None]) * self.channel_gains[:, None]
+            self._lookup_tables[dtype] = np.clip(np.rint(tables), 0, limits.max).astype(dtype)
+        return self._lookup_tables[dtype]
+
+    def save(self, group):
+        """Store the references and derived gains in a datafile group"""
+        group.create_dataset('dark', data=self.dark)
+        group.create_dataset('flat', data=self.flat)
+        group.create_dataset('gain', data=self.gain)
+        group.create_dataset('channel_gains', data=self.channel_gains)
+        group.create_dataset('channel_darks', data=self.channel_darks)
+
+
+class SpectrumAnalyser:
+    """Derived time series, updated incrementally as each spectrum arrives
+
+    Band integrals, ratios and the tracked peak are computed from index masks
+    and weights prepared once from the wavelengths, so each update costs one
+    pass over the spectrum regardless of how long the run has been going.
+    History is kept in arrays that double in size when full.
+
+    :param wavelengths: wavelength of each spectrometer pixel, in nm
+    :param bands: (low, high) wavelength ranges to integrate
+    :param ratios: (numerator, denominator) wavelengths to take intensity ratios of
+    :param peak_range: (low, high) wavelength range to track the peak in, or None for all.
+        A range containing no pixels also falls back to all, with peak_range
+        set to None to say so.
+    """
+    def __init__(self, wavelengths, bands=(), ratios=(), peak_range=None):
+        wavelengths = np.asarray(wavelengths, dtype=float)
+        self.columns = ([f'band_{low:g}_{high:g}' for low, high in bands]
+                        + [f'ratio_{num:g}_{den:g}' for num, den in ratios]
+                        + ['peak_wavelength', 'peak_height'])
+
+        # Integrating every band is then a single matrix-vector product
+        pixel_widths = np.abs(np.gradient(wavelengths))
+        self._band_weights = np.array(
+            [np.where((wavelengths >= low) & (wavelengths <= high), pixel_widths, 0)
+             for low, high in bands]).reshape(len(bands), len(wavelengths))
+        self._ratio_pixels = np.array(
+            [[np.abs(wavelengths - num).argmin(), np.abs(wavelengths - den).argmin()]
+             for num, den in ratios], dtype=int).reshape(len(ratios), 2)
+        if peak_range is None:
+            self._peak_pixels = np.arange(len(wavelengths))
+        else:
+            low, high = peak_range
+            self._peak_pixels = np.flatnonzero((wavelengths >= low) & (wavelengths <= high))
+            if len(self._peak_pixels) == 0:
+                self._peak_pixels = np.arange(len(wavelengths))
+                peak_range = None
+        self.peak_range = peak_range
+        self._peak_wavelengths = wavelengths[self._peak_pixels]
+
+        self._lock = threading.Lock()
+        self._times = np.zeros(64)
+        self._values = np.zeros((64, len(self.columns)))
+        self._length = 0
+
+    def update(self, spectrum, timestamp):
+        """Add a spectrum to the series and return its row of derived values"""
+        spectrum = np.asarray(spectrum, dtype=float).ravel()
+        bands = self._band_weights @ spectrum
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = spectrum[self._ratio_pixels[:, 0]] / spectrum[self._ratio_pixels[:, 1]]
+        peak_region = spectrum[self._peak_pixels]
+        peak = peak_region.argmax()
+        row = np.concatenate([bands, ratios,
+                              [self._peak_wavelengths[peak], peak_region[peak]]])
+
+        with self._lock:
+            if self._length == len(self._times):
+                self._times = np.concatenate([self._times, np.zeros_like(self._times)])
+                self._values = np.concatenate([self._values, np.zeros_like(self._values)])
+            self._times[self._length] = timestamp
+            self._values[self._length] = row
+            self._length += 1
+        return row
+
+    def history(self):
+        """Return copies of the times and derived values so far"""
+        with self._lock:
+            return (self._times[:self._length].copy(),
+                    self._values[:self._length].copy())
+
+
+class AnalysisPlot(QtWidgets.QWidget):
+    """Plots the experiment's derived spectral time series as they update"""
+    def __init__(self, experiment, parent=None):
+        super().__init__(parent)
+        self.experiment = experiment
+        self.analyser = None
+        self.curves = {}
+        layout = QtWidgets.QVBoxLayout(self)
+        self.plot = pg.PlotWidget(title='Spectral analysis')
+        self.plot.addLegend()
+        self.plot.setLabel('bottom', 'Time', 'min')
+        layout.addWidget(self.plot)
+
+        # The experiment thread updates the analyser, so we poll it from the GUI thread
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.update_plot)
+        self.timer.start(1000)
+
+    def update_plot(self):
+        analyser = self.experiment.analyser
+        if analyser is None:
+            return
+        if analyser is not self.analyser:  # A new run has started
+            self.analyser = analyser
+            self.plot.clear()
+            self.curves = {column: self.plot.plot(pen=(index, len(analyser.columns)), name=column)
+                           for index, column in enumerate(analyser.columns)}
+        times, values = analyser.history()
+        if len(times) == 0:
+            return
+        times = (times - times[0]) / 60
+        for index, column in enumerate(analyser.columns):
+            self.curves[column].setData(times, values[:, index])
+
+
+class BackgroundLog:
+    """Takes log messages off the calling thread
+
+    put() only adds the message to a bounded queue, dropping it if the queue
+    is full. A background thread collapses repeats of the same message,
+    rate-limits each distinct message that keeps coming back (errors are
+    never limited), and passes batches of (time, level, message) to write,
+    at most every flush_interval seconds.
+    """
+    levels = {'debug': 10, 'info': 20, 'warn': 30, 'warning': 30, 'error': 40, 'critical': 50}
+
+    def __init__(self, write, queue_size=1000, rate_limit=10, flush_interval=5):
+        self.write = write
+        self.rate_limit = rate_limit  # of each message per second, also the largest burst
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='BackgroundLog', daemon=True)
+        self._thread.start()
+
+    def put(self, message, level='info'):
+        try:
+            self._queue.put_nowait((time.time(), level, message))
+        except queue.Full:
+            with self._dropped_lock:
+                self._dropped += 1
+
+    def flush(self, timeout=5):
+        """Block until everything put so far has been written"""
+        written = threading.Event()
+        try:
+            self._queue.put(written, timeout=timeout)
+        except queue.Full:
+            return False
+        return written.wait(timeout)
+
+    def _run(self):
+        batch = []
+        last_write = time.time()
+        repeated = None  # [time, level, message, count] of the message being repeated
+        suppressed = 0
+        buckets = {}  # (level, message) -> [tokens, time they were counted]
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = None
+            flushing = isinstance(item, threading.Event)
+
+            if item is not None and not flushing:
+                timestamp, level, message = item
+                if repeated is not None and repeated[1:3] == [level, message]:
+                    repeated[3] += 1
+                    item = None
+                else:
+                    self._end_repeat(repeated, batch)
+                    repeated = [timestamp, level, message, 0]
+            if item is not None and not flushing:
+                now = time.time()
+                tokens, counted = buckets.get((level, message), (self.rate_limit, now))
+                tokens = min(self.rate_limit, tokens + (now - counted) * self.rate_limit)
+                if tokens >= 1 or self.levels.get(level, 20) >= self.levels['error']:
+                    tokens -= 1
+                    batch.append((timestamp, level, message))
+                else:
+                    suppressed += 1
+                buckets[(level, message)] = [tokens, now]
+
+            if flushing or time.time() - last_write >= self.flush_interval:
+                self._end_repeat(repeated, batch)
+                repeated = None
+                if suppressed:
+                    batch.append((time.time(), 'warn',
+                                  f'Suppressed {suppressed} log messages that kept recurring'))
+                    suppressed = 0
+                with self._dropped_lock:
+                    dropped, self._dropped = self._dropped, 0
+                if dropped:
+                    batch.append((time.time(), 'warn', f'Dropped {dropped} log messages, queue full'))
+                if batch:
+                    try:
+                        self.write(batch)
+                    except Exception as e:
+                        print(f'Could not write log messages: {str(e)}')
+                batch = []
+                last_write = time.time()
+                # A bucket untouched for a second has refilled, so needn't be kept
+                buckets = {key: bucket for key, bucket in buckets.items()
+                           if last_write - bucket[1] < 1}
+            if flushing:
+                item.set()
+
+    @staticmethod
+    def _end_repeat(repeated, batch):
+        if repeated is not None and repeated[3] > 0:
+            timestamp, level, message, count = repeated
+            batch.append((timestamp, level, f'(last message repeated {count} times)'))
+
+
+class IterationMetrics:
+    """Timing spans and device counters for one experiment iteration
+
+    Spans accumulate wall-clock seconds, counters accumulate numbers. Both are
+    reset at the start of each iteration and saved as one row per iteration.
+    """
+    span_names = ('drift', 'focus', 'capture', 'zstack', 'spectrum', 'write', 'wait')
+    counter_names = ('tango_calls', 'stage_travel', 'frames_grabbed')
+
+    def __init__(self):
+        self.spans = dict.fromkeys(self.span_names, 0.0)
+        self.counters = dict.fromkeys(self.counter_names, 0.0)
+        self._stage_position = {}  # Last known position by axis number
+
+    def reset(self):
+        for name in self.spans:
+            self.spans[name] = 0.0
+        for name in self.counters:
+            self.counters[name] = 0.0
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[name] += time.perf_counter() - start
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def span_row(self):
+        return np.array([self.spans[name] for name in self.span_names])
+
+    def counter_row(self):
+        return np.array([self.counters[name] for name in self.counter_names])
+
+    def instrument_stage(self, stage):
+        """Wrap the stage's DLL functions so that every call is counted
+
+        The Tango wraps each DLL function in a CamelCase method, so those are
+        the ones we count. Moves also add to the stage travel counter.
+        """
+        for name in dir(type(stage)):
+            if not name[:1].isupper():
+                continue
+            method = getattr(stage, name)
+            if callable(method):
+                setattr(stage, name, self._counted_dll_call(name, method))
+
+    def instrument_camera(self, camera):
+        """Wrap raw_image so that every frame grabbed is counted
+
+        CameraWithLocation's autofocus gets its frames through raw_image too.
+        """
+        raw_image = camera.raw_image
+
+        def counted_raw_image(*args, **kwargs):
+            self.count('frames_grabbed')
+            return raw_image(*args, **kwargs)
+        camera.raw_image = counted_raw_image
+
+    def _counted_dll_call(self, name, method):
+        def counted(*args, **kwargs):
+            self.count('tango_calls')
+            result = method(*args, **kwargs)
+            self._track_stage_travel(name, args, result)
+            return result
+        return counted
+
+    def _track_stage_travel(self, name, args, result):
+        position = self._stage_position
+        if name == 'MoveRelSingleAxis':
+            axis_number, value = args[:2]
+            self.count('stage_travel', abs(value))
+            if axis_number in position:
+                position[axis_number] += value
+        elif name == 'MoveAbsSingleAxis':
+            axis_number, value = args[:2]
+            if axis_number in position:  # Travel is unknown until we've read a position
+                self.count('stage_travel', abs(value - position[axis_number]))
+            position[axis_number] = value
+        elif name == 'GetPos':
+            for axis, value in result.items():
+                position[translate_axis(axis)] = value
+        elif name == 'GetPosSingleAxis':
+            position[args[0]] = result
 
 
 class BioFuMExperiment(Experiment):
     reading_interval = DumbNotifiedProperty(10)  # minutes
+    metrics_file = DumbNotifiedProperty('')  # Optional CSV to export iteration metrics to
+    drift_correction = DumbNotifiedProperty(True)
+    drift_roi_fraction = DumbNotifiedProperty(0.5)  # Central fraction of the frame to register
+    drift_downsample = DumbNotifiedProperty(4)  # Bin the ROI by this factor before registering
+    drift_tolerance = DumbNotifiedProperty(2)  # pixels; smaller shifts aren't corrected
+    drift_min_peak = DumbNotifiedProperty(0.05)  # Weaker correlation peaks are ignored
+    drift_refresh_peak = DumbNotifiedProperty(0.1)  # Take a new reference below this, before it's lost
+    adaptive_interval = DumbNotifiedProperty(False)  # Adapt reading interval to how fast things change
+    min_interval = DumbNotifiedProperty(1)  # minutes
+    max_interval = DumbNotifiedProperty(60)  # minutes
+    change_threshold = DumbNotifiedProperty(0.05)  # Relative change that counts as a transition
+    change_downsample = DumbNotifiedProperty(8)  # Bin frames by this factor to compare them
+    analysis_bands = ((400, 500), (500, 600), (600, 700))  # nm ranges to integrate
+    analysis_ratios = ()  # (numerator, denominator) wavelengths in nm
+    analysis_peak_range = None  # nm range to track the peak in, None for the whole spectrum
+    zstack_planes = DumbNotifiedProperty(0)  # Planes to capture round best focus, 0 to disable
+    zstack_spacing = DumbNotifiedProperty(20)  # Stage units between planes
+    save_raw_stack = DumbNotifiedProperty(False)  # Store every plane, not just the fused image
+    fusion_workers = 2  # Processes fusing z-stacks off the acquisition thread
+    calibration_modes = ('off', 'capture', 'read')  # See correct_frame
+    calibration_mode = DumbNotifiedProperty(0)  # Index into calibration_modes, as the combobox sets it
+    flat_field_correction = DumbNotifiedProperty(True)  # False corrects white balance only
+    calibration_frames = 10  # Frames averaged for each reference
+    save_previews = DumbNotifiedProperty(True)  # Thumbnail of every frame, for browsing runs
+    save_pyramid = DumbNotifiedProperty(True)  # Also keep every halved level, not just thumbnails
+    thumbnail_size = 128  # Longest side of a thumbnail, in pixels
+    log_levels = ('debug', 'info', 'warn', 'error')
+    log_level = DumbNotifiedProperty(1)  # Index into log_levels; less severe messages are discarded
+    log_history_lines = 1000  # Lines kept in log_messages for display
 
-    def __init__(self, reading_interval=10):
+    def __init__(self, reading_interval=10, com_name='COM1', camera_number=1,
+                 spectrometer_index=0):
         super().__init__()
         self.reading_interval = reading_interval
+        self.log_group = None  # Datafile group for log messages, while running
+        self.session_log_group = None  # Where messages from outside a run are saved
+        self.log_history = deque(maxlen=self.log_history_lines)
+        self.log_history_lock = threading.Lock()  # Cleared by run(), filled by the log thread
+        self.logger = logging.getLogger(type(self).__name__)
+        self.background_log = BackgroundLog(self.write_log_batch)
 
         #  Initialise devices
         self.log('Creating Tango')
-        self.stage = Tango(com_name='COM1')
+        self.stage = Tango(com_name=com_name)
 
         self.log('Creating Lumenera Camera')
-        self.camera = LumeneraCamera()
+        self.camera = LumeneraCamera(camera_number)
         # Setting video_priority=True means that images we take will come from the video stream
         # Otherwise, LumeneraCamera will take images with default settings
         # Which sounds sensible, but the default settings override white-balance
@@ -32,72 +558,495 @@ class BioFuMExperiment(Experiment):
         self.camera.live_view = True  # Just so the preview is running by default
 
         self.log('Creating Ocean Optics Spectrometer')
-        self.spectrometer = OceanOpticsSpectrometer(0)
+        self.spectrometer = OceanOpticsSpectrometer(spectrometer_index)
 
         self.log('Creating Camera-With-Location (camera + stage)')
         self.camera_and_stage = CameraWithLocation(self.camera, self.stage)
 
+        self.metrics = IterationMetrics()
+        self.metrics.instrument_stage(self.stage)
+        self.metrics.instrument_camera(self.camera)
+
+        self.drift_reference = None
+        self.previous_frame = None
+        self.previous_spectrum = None
+        self.analyser = None
+        self.fusion_pool = None
+        self.pending_stacks = []  # (future, z offsets, iteration) of stacks being fused
+        self.preview_pool = None
+        self.pending_previews = []  # (future, iteration) of pyramids being built
+        self.dark_reference = None
+        self.flat_reference = None
+        self.calibration = None
+        self.run_calibration_mode = 'off'  # calibration_mode and flat_field_correction
+        self.run_flat_field = True  # as they were when the current run started
 
     def run(self, *args, **kwargs):
         iteration = 0
+        zstacks = None
+        previews = None
         try:
+            self.background_log.flush()  # Earlier messages belong in the session log
+            with self.log_history_lock:
+                self.log_history.clear()
+            self.log_group = self.create_data_group('log_%d')
             self.log('Starting experiment')
             images = self.create_data_group('images_%d')
             spectra = self.create_data_group('spectra_%d')
+            metrics = self.create_data_group('metrics_%d')
+            metrics.attrs['span_names'] = list(IterationMetrics.span_names)
+            metrics.attrs['counter_names'] = list(IterationMetrics.counter_names)
+            drift = self.create_data_group('drift_%d')
+            drift.attrs['shift_columns'] = ['row', 'column', 'peak', 'corrected']
+            self.drift_reference = None
+            intervals = self.create_data_group('intervals_%d')
+            intervals.attrs['decision_columns'] = ['spectral_distance', 'frame_difference',
+                                                   'interval']
+            self.previous_frame = None
+            self.previous_spectrum = None
+            interval = self.reading_interval
+            self.analyser = SpectrumAnalyser(self.spectrometer.wavelengths,
+                                             self.analysis_bands,
+                                             self.analysis_ratios,
+                                             self.analysis_peak_range)
+            if self.analysis_peak_range is not None and self.analyser.peak_range is None:
+                self.log(f'No spectrometer pixels in analysis_peak_range {self.analysis_peak_range}, '
+                         'tracking the peak over the whole spectrum', level='warn')
+            analysis = self.create_data_group('analysis_%d')
+            analysis.attrs['columns'] = self.analyser.columns
+            previews = self.create_data_group('previews_%d')
+            previews.attrs['thumbnail_size'] = self.thumbnail_size
+            if self.save_previews:
+                self.preview_pool = ThreadPoolExecutor(max_workers=1)
+            # Fixed for the run, so frames are all corrected as the datafile says
+            self.run_calibration_mode = self.calibration_modes[self.calibration_mode]
+            self.run_flat_field = self.flat_field_correction
+            calibration = self.create_data_group('calibration_%d')
+            calibration.attrs['mode'] = self.run_calibration_mode
+            calibration.attrs['flat_field'] = self.run_flat_field
+            if self.calibration is not None:
+                self.calibration.save(calibration)
+            elif self.run_calibration_mode != 'off':
+                self.log('No colour calibration captured, frames will not be corrected')
+            # Created even when unused, so every run's groups share its number
+            zstacks = self.create_data_group('zstacks_%d')
+            zstack_planes = self.zstack_planes  # Fixed for the run, whatever the GUI does
+            if zstack_planes > 1:
+                self.fusion_pool = ProcessPoolExecutor(max_workers=self.fusion_workers)
 
             while True:
                 self.log(f"Starting iteration {iteration}")
                 iteration_start = time.time()
+                self.metrics.reset()
+
+                field_locked = False
+                if self.drift_correction and self.drift_reference is not None:
+                    self.log('Correcting drift')
+                    with self.metrics.span('drift'):
+                        field_locked = self.correct_drift(drift)
+                else:
+                    drift.append_dataset('shift', np.full(4, np.nan))
 
                 self.log('Focusing')
-                self.autofocus()
+                with self.metrics.span('focus'):
+                    # With the field of view locked, best focus won't have moved far
+                    self.autofocus(coarse=not field_locked)
                 self.log('Taking picture')
-                images.create_dataset('image_%d',
-                                      data=self.camera.raw_image(
-                                          bundle_metadata=True,
-                                          update_latest_frame=True))
+                with self.metrics.span('capture'):
+                    image = self.correct_frame(self.camera.raw_image(bundle_metadata=True,
+                                                                     update_latest_frame=True))
+                if self.drift_correction and self.drift_reference is None:
+                    self.drift_reference = to_grayscale(image, self.drift_roi_fraction,
+                                                        self.drift_downsample)
+                    drift.append_dataset('reference_iteration', iteration, dtype='i8')
+                with self.metrics.span('write'):
+                    images.create_dataset('image_%d', data=image)
+                    if self.preview_pool is not None:
+                        self.pending_previews.append(
+                            (self.preview_pool.submit(self.build_preview, np.array(image)),
+                             iteration))
+                        self.write_previews(previews)
+                if self.fusion_pool is not None:
+                    self.log('Capturing z-stack')
+                    with self.metrics.span('zstack'):
+                        stack, offsets = self.capture_zstack(zstack_planes)
+                    with self.metrics.span('write'):
+                        if self.save_raw_stack:
+                            zstacks.create_dataset('stack_%d', data=stack,
+                                                   attrs={'z_offsets': offsets,
+                                                          'iteration': iteration})
+                        self.pending_stacks.append(
+                            (self.fusion_pool.submit(fuse_stack, stack), offsets, iteration))
+                        self.write_fused_stacks(zstacks)
                 self.log('Reading spectrum')
-                spectra.create_dataset('spectrum_%d',
-                                       data=self.spectrometer.read_spectrum(
-                                           bundle_metadata=True))
+                with self.metrics.span('spectrum'):
+                    spectrum = self.spectrometer.read_spectrum(bundle_metadata=True)
+                with self.metrics.span('write'):
+                    spectra.create_dataset('spectrum_%d', data=spectrum)
+                    spectrum_time = time.time()
+                    analysis.append_dataset('series', self.analyser.update(spectrum, spectrum_time),
+                                            dtype='f8')
+                    analysis.append_dataset('time', spectrum_time, dtype='f8')
 
-                next_iteration = iteration_start + (self.reading_interval * 60)
+                interval = self.choose_interval(interval, image, spectrum, intervals)
+                next_iteration = iteration_start + (interval * 60)
                 time_to_wait = next_iteration - time.time()
                 self.log(f'Iteration {iteration} complete. Waiting...')
-                self.wait_or_stop(time_to_wait)
+                try:
+                    with self.metrics.span('wait'):
+                        self.wait_or_stop(time_to_wait)
+                finally:
+                    # Save metrics even if we were stopped while waiting
+                    self.save_metrics(metrics, iteration, iteration_start)
                 iteration += 1
         except ExperimentStopped:
             pass  # don't raise an error if we just clicked "stop"
         except Exception as e:
-            self.log('Error!')
-            self.log(str(e))
-            self.log(traceback.format_exc())
-            self.log('Ending experiment')
-            raise ExperimentStopped()
+            self.log('Error!', level='error')
+            self.log(str(e), level='error')
+            self.log(traceback.format_exc(), level='error')
+            self.log('Ending experiment', level='error')
+            raise ExperimentStopped(str(e)) from e
+        finally:
+            if self.fusion_pool is not None:
+                self.finish_fusion(zstacks)
+            if self.preview_pool is not None:
+                self.finish_previews(previews)
+            self.background_log.flush()
+            self.log_group = None
+
+    def log(self, message, level='info'):
+        """Log a message without waiting for it to be displayed or saved
+
+        Messages below log_level are dropped here. The rest are handed to the
+        background log, which writes them in batches (see write_log_batch).
+        """
+        levels = BackgroundLog.levels
+        level = level.lower()
+        if levels.get(level, levels['info']) >= levels[self.log_levels[self.log_level]]:
+            self.background_log.put(message, level)
+
+    def write_log_batch(self, batch):
+        """Show a batch of log messages and save them to the datafile
+
+        Runs on the background log's thread. Each batch is saved as one dataset
+        in the run's log group, rather than one dataset per message. Messages
+        from outside a run go in a session_log_%d group instead.
+        """
+        for timestamp, level, message in batch:
+            self.logger.log(BackgroundLog.levels.get(level, logging.INFO), message)
+            if self.log_to_console:
+                print(message)
+        with self.log_history_lock:
+            self.log_history.extend(message for timestamp, level, message in batch)
+            log_messages = '\n'.join(self.log_history) + '\n'
+        self.log_messages = log_messages
+        log_group = self.log_group
+        if log_group is None:
+            if self.session_log_group is None:
+                try:
+                    self.session_log_group = self.create_data_group('session_log_%d')
+                except Exception as e:
+                    self.logger.warning(f'Could not save log messages: {str(e)}')
+                    return
+            log_group = self.session_log_group
+        times, levels, messages = zip(*batch)
+        log_group.create_dataset('entries_%d',
+                                 data=np.array([m.encode('utf-8') for m in messages]),
+                                 attrs={'times': np.array(times),
+                                        'levels': np.array([l.encode() for l in levels])})
+
+    def correct_frame(self, frame):
+        """Apply the colour calibration to a frame, if the run's calibration_mode is 'capture'
+
+        In 'read' mode frames are stored raw, alongside the calibration, and
+        corrected by whoever reads them (biofum-reader.py does this). Every
+        frame goes through here, including drift and z-stack frames, so they
+        can all be compared with each other.
+
+        The mode and flat_field_correction are those saved when the run
+        started; changing them in the GUI takes effect at the next run.
+        """
+        if self.run_calibration_mode != 'capture' or self.calibration is None:
+            return frame
+        corrected = self.calibration.apply(frame, self.run_flat_field)
+        return ArrayWithAttrs(corrected, attrs=getattr(frame, 'attrs', {}))
+
+    def average_frames(self):
+        frames = [self.camera.raw_image(update_latest_frame=True).astype(np.float32)
+                  for _ in range(self.calibration_frames)]
+        return np.mean(frames, axis=0)
+
+    def capture_dark_reference(self, *args, **kwargs):
+        """Average frames with the illumination off, for the calibration"""
+        if self.refuse_while_running():
+            return
+        self.log('Capturing dark reference')
+        self.dark_reference = self.average_frames()
+        self.update_calibration()
+
+    def capture_flat_reference(self, *args, **kwargs):
+        """Average frames of a blank, evenly lit field, for the calibration"""
+        if self.refuse_while_running():
+            return
+        self.log('Capturing flat-field reference')
+        self.flat_reference = self.average_frames()
+        self.update_calibration()
+
+    def refuse_while_running(self):
+        """Return True (and say so) if the experiment is running
+
+        A run saves its calibration when it starts, so changing it mid-run
+        would leave frames corrected with gains that aren't in the datafile.
+        """
+        if self.running:
+            self.log('Stop the experiment before capturing calibration references', level='warn')
+        return self.running
+
+    def update_calibration(self):
+        if self.dark_reference is None or self.flat_reference is None:
+            return
+        if self.dark_reference.shape != self.flat_reference.shape:
+            self.log('Dark and flat references are different sizes, capture them again')
+            return
+        self.calibration = ColourCalibration(self.dark_reference, self.flat_reference)
+        self.log(f'Colour calibration updated, channel gains {self.calibration.channel_gains}')
+
+    def capture_zstack(self, planes):
+        """Capture planes frames in one sweep up through the current focus
+
+        Returns the stack (planes x H x W x channels) and each plane's z offset
+        from the starting position, which the stage returns to afterwards.
+        Planes are corrected the same way as every other frame (correct_frame).
+        """
+        here = np.array(self.stage.position)
+        offsets = (np.arange(planes) - (planes - 1) / 2) * self.zstack_spacing
+        frames = []
+        try:
+            for dz in offsets:
+                self.stage.move(np.array([0, 0, dz]) + here)
+                self.camera_and_stage.settle()
+                frames.append(self.correct_frame(self.camera.raw_image(update_latest_frame=True)))
+        finally:
+            self.stage.move(here)
+        return np.stack(frames), offsets
+
+    def write_fused_stacks(self, zstacks, wait=False):
+        """Save the fused image and depth map of every z-stack that has finished
+
+        Results are written in the order the stacks were captured. If wait is
+        True, block until all of them have finished.
+        """
+        while self.pending_stacks and (wait or self.pending_stacks[0][0].done()):
+            future, offsets, iteration = self.pending_stacks.pop(0)
+            try:
+                fused, depth = future.result()
+            except Exception as e:
+                self.log(f'Fusing z-stack from iteration {iteration} failed: {str(e)}')
+                continue
+            attrs = {'z_offsets': offsets, 'iteration': iteration}
+            zstacks.create_dataset('fused_%d', data=fused, attrs=attrs)
+            zstacks.create_dataset('depth_%d', data=depth, attrs=attrs)
+
+    def write_previews(self, previews, wait=False):
+        """Save the thumbnail (and pyramid) of every frame that's been downsampled
+
+        Thumbnails go into one dataset, a row per frame, so browsing a run
+        only has to read that. The other levels go in a pyramid_%d group per
+        frame, level_1 being half size, with the frame's iteration as an
+        attribute.
+        """
+        while self.pending_previews and (wait or self.pending_previews[0][0].done()):
+            future, iteration = self.pending_previews.pop(0)
+            try:
+                levels = future.result()
+                # Keep the frame's dtype; h5py would otherwise make it float32
+                previews.append_dataset('thumbnails', levels[-1], dtype=levels[-1].dtype)
+                previews.append_dataset('thumbnail_iteration', iteration, dtype='i8')
+            except Exception as e:
+                self.log(f'Saving preview from iteration {iteration} failed: {str(e)}')
+                continue
+            if self.save_pyramid and len(levels) > 1:
+                pyramid = previews.create_group('pyramid_%d')
+                pyramid.attrs['iteration'] = iteration
+                for number, level in enumerate(levels[1:], start=1):
+                    pyramid.create_dataset(f'level_{number}', data=level)
+
+    def build_preview(self, image):
+        """Return the pyramid of a frame, colour-corrected in every calibration mode
+
+        Runs on the preview thread. In 'read' mode the frame is stored raw,
+        but the reader's full-size calibration can't be applied to a
+        thumbnail, so previews are corrected here instead.
+        """
+        if self.run_calibration_mode == 'read' and self.calibration is not None:
+            image = self.calibration.apply(image, self.run_flat_field)
+        return build_pyramid(image, self.thumbnail_size)
+
+    def finish_previews(self, previews):
+        """Save any previews still being built and shut down the worker thread"""
+        try:
+            if previews is not None:
+                self.write_previews(previews, wait=True)
+        finally:
+            self.preview_pool.shutdown()
+            self.preview_pool = None
+            self.pending_previews = []
+
+    def finish_fusion(self, zstacks):
+        """Save any z-stacks still being fused and shut down the worker processes"""
+        try:
+            if zstacks is not None:
+                self.write_fused_stacks(zstacks, wait=True)
+        finally:
+            self.fusion_pool.shutdown()
+            self.fusion_pool = None
+            self.pending_stacks = []
+
+    def correct_drift(self, drift):
+        """Measure the XY shift from the reference frame and move to cancel it
+
+        The shift (in full-resolution pixels) is appended to the drift group.
+        Returns True if the field of view is locked onto the reference.
+
+        The sample changes over a long run, so the match with the reference
+        gets weaker. Once its peak falls below drift_refresh_peak, the
+        reference is dropped (after correcting, if the shift was reliable)
+        and the next frame captured becomes the new one. The iteration of
+        every reference is saved in the drift group as reference_iteration.
+        """
+        frame = self.correct_frame(self.camera.raw_image(update_latest_frame=True))
+        current = to_grayscale(frame, self.drift_roi_fraction, self.drift_downsample)
+        if current.shape != self.drift_reference.shape:
+            self.log('Frame size changed, resetting drift reference')
+            self.drift_reference = None
+            drift.append_dataset('shift', np.full(4, np.nan))
+            return False
+        shift, peak = estimate_shift(self.drift_reference, current)
+        shift *= self.drift_downsample
+        self.log(f'Measured drift of {shift[0]:.1f}, {shift[1]:.1f} pixels (peak {peak:.2f})')
+
+        corrected = False
+        if peak < self.drift_min_peak:
+            self.log('Drift measurement unreliable, not correcting')
+        elif np.hypot(*shift) < self.drift_tolerance:
+            corrected = True  # Already within tolerance
+        elif self.camera_and_stage.pixel_to_sample_displacement is None:
+            self.log('Camera-With-Location is not calibrated, not correcting drift')
+        else:
+            # The feature that was at the datum pixel is now at datum + shift
+            target = self.camera_and_stage.datum_pixel + shift
+            self.camera_and_stage.move_to_pixel(*target)
+            self.camera_and_stage.settle()
+            corrected = True
+        drift.append_dataset('shift', np.array([*shift, peak, corrected]))
+        if peak < self.drift_refresh_peak:
+            self.log(f'Drift reference match is weak (peak {peak:.2f}), taking a new reference',
+                     level='info' if corrected else 'warn')
+            self.drift_reference = None
+        return corrected
+
+    def reset_drift_reference(self, *args, **kwargs):
+        """Use the next captured frame as the new drift reference"""
+        self.drift_reference = None
+
+    def choose_interval(self, interval, image, spectrum, intervals):
+        """Return the interval (in minutes) to wait before the next iteration
+
+        Compares the new frame and spectrum with the previous ones. In adaptive
+        mode the interval shrinks during transitions and grows while steady,
+        within min_interval and max_interval. Otherwise it's reading_interval.
+        Every decision is appended to the intervals group.
+        """
+        frame = to_grayscale(image, downsample=self.change_downsample)
+        if self.previous_spectrum is None or np.shape(spectrum) != np.shape(self.previous_spectrum):
+            spectrum_change = np.nan
+        else:
+            spectrum_change = spectral_distance(self.previous_spectrum, spectrum)
+        if self.previous_frame is None or frame.shape != self.previous_frame.shape:
+            frame_change = np.nan
+        else:
+            frame_change = frame_difference(self.previous_frame, frame)
+        self.previous_frame = frame
+        self.previous_spectrum = np.array(spectrum)
+
+        if not self.adaptive_interval:
+            interval = self.reading_interval
+        elif not (np.isnan(spectrum_change) and np.isnan(frame_change)):
+            change = np.nanmax([spectrum_change, frame_change])
+            interval = next_interval(interval, change, self.change_threshold,
+                                     self.min_interval, self.max_interval)
+            self.log(f'Change of {change:.3f}, next reading in {interval:.1f} minutes')
+        intervals.append_dataset('decisions', np.array([spectrum_change, frame_change, interval]))
+        return interval
+
+    def save_metrics(self, metrics, iteration, iteration_start):
+        """Append this iteration's spans and counters to the metrics group"""
+        span_row = self.metrics.span_row()
+        counter_row = self.metrics.counter_row()
+        # h5py would otherwise store these as float32, too coarse for a timestamp
+        metrics.append_dataset('spans', span_row, dtype='f8')
+        metrics.append_dataset('counters', counter_row, dtype='f8')
+        metrics.append_dataset('iteration_start', iteration_start, dtype='f8')
+        if self.metrics_file:
+            self.export_metrics(iteration, iteration_start, span_row, counter_row)
+
+    def export_metrics(self, iteration, iteration_start, span_row, counter_row):
+        """Append one line per iteration to the CSV at metrics_file"""
+        try:
+            write_header = not os.path.exists(self.metrics_file)
+            with open(self.metrics_file, 'a') as f:
+                if write_header:
+                    columns = (('iteration', 'iteration_start')
+                               + IterationMetrics.span_names
+                               + IterationMetrics.counter_names)
+                    f.write(','.join(columns) + '\n')
+                values = [iteration, iteration_start, *span_row, *counter_row]
+                f.write(','.join(str(value) for value in values) + '\n')
+        except OSError as e:
+            self.log(f'Could not export metrics: {str(e)}')
 
     def get_qt_ui(self):
         """Return basic controls GUI for the experiment"""
         box = QuickControlBox("BioFuM Experiment")
         box.add_doublespinbox("reading_interval")
+        box.add_checkbox('adaptive_interval')
+        box.add_doublespinbox('min_interval')
+        box.add_doublespinbox('max_interval')
+        box.add_doublespinbox('change_threshold')
+        box.add_lineedit('metrics_file')
+        box.add_combobox('log_level', self.log_levels)
         box.add_button("start")
         box.add_button("stop")
         box.add_doublespinbox('x_velocity')
         box.add_doublespinbox('y_velocity')
         box.add_doublespinbox('z_velocity')
         box.add_button('OneShotAutoWhiteBalance')
+        box.add_button('capture_dark_reference')
+        box.add_button('capture_flat_reference')
+        box.add_combobox('calibration_mode', self.calibration_modes)
+        box.add_checkbox('flat_field_correction')
         box.add_button('autofocus')
+        box.add_checkbox('drift_correction')
+        box.add_button('reset_drift_reference')
+        box.add_spinbox('zstack_planes')
+        box.add_doublespinbox('zstack_spacing')
+        box.add_checkbox('save_raw_stack')
+        box.add_checkbox('save_previews')
+        box.add_checkbox('save_pyramid')
         box.auto_connect_by_name(self)
         box.setMinimumWidth(400)
         return box
 
-    def autofocus(self):
+    def autofocus(self, *args, coarse=True, **kwargs):
         start_z_speed = self.z_velocity
         self.z_velocity = 15 # decent speed for focusing
 
-        # Rough focus to within 1000 units
-        self.camera_and_stage.af_step_size = 500
-        self.camera_and_stage.af_steps = 7 # Checks 3 steps in each direction
-        self.camera_and_stage.autofocus()
+        if coarse:
+            # Rough focus to within 1000 units
+            self.camera_and_stage.af_step_size = 500
+            self.camera_and_stage.af_steps = 7 # Checks 3 steps in each direction
+            self.camera_and_stage.autofocus()
 
         # Finer focus to within 200 units
         self.camera_and_stage.af_steps = 9 # Checks 4 steps in each direction
@@ -116,7 +1065,7 @@ class BioFuMExperiment(Experiment):
 
     @property
     def x_velocity(self):
-        print('x_velocity getter called')
+        self.log('x_velocity getter called', level='debug')
         return self.stage.GetVel()['x']
 
     @x_velocity.setter
@@ -127,7 +1076,7 @@ class BioFuMExperiment(Experiment):
 
     @property
     def y_velocity(self):
-        print('y_velocity getter called')
+        self.log('y_velocity getter called', level='debug')
         return self.stage.GetVel()['y']
 
     @y_velocity.setter
@@ -138,7 +1087,7 @@ class BioFuMExperiment(Experiment):
 
     @property
     def z_velocity(self):
-        print('z_velocity getter called')
+        self.log('z_velocity getter called', level='debug')
         return self.stage.GetVel()['z']
 
     @z_velocity.setter
@@ -180,6 +1129,11 @@ class BioFuMExperimentGui(QtWidgets.QMainWindow, UiTools):
             self.Spectrometer_viewer,
             self.experiment.spectrometer.get_qt_ui())
 
+        self.Analysis_viewer = self.replace_widget(
+            self.Device_viewers_layout,
+            self.Analysis_viewer,
+            AnalysisPlot(self.experiment))
+
 
 if __name__ == '__main__':
     try:
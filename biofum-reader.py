@@ -0,0 +1,355 @@
+import re
+import sys
+import datetime
+import argparse
+import h5py
+import numpy as np
+
+
+def data_folder(datafile):
+    """Return the group the experiment writes its runs into
+
+    nplab puts an instrument's data in a group named after its class, but
+    fall back to the root of the file for datafiles written some other way.
+    """
+    return datafile.get('BioFuMExperiment', datafile)
+
+
+def creation_time(item):
+    """When nplab created a group or dataset, as a POSIX timestamp (NaN if unknown)
+
+    nplab stores datetime.now().isoformat(), which is local time without a
+    timezone, so it has to be read as local time too.
+    """
+    timestamp = item.attrs.get('creation_timestamp')
+    if timestamp is None:
+        return np.nan
+    if isinstance(timestamp, bytes):
+        timestamp = timestamp.decode()
+    return datetime.datetime.fromisoformat(timestamp).timestamp()
+
+
+def numbered_names(group, prefix):
+    """Return the names in group of the form prefix_N, sorted by N"""
+    pattern = re.compile(rf'^{re.escape(prefix)}_(\d+)$')
+    numbered = [(int(match.group(1)), name) for name in group.keys()
+                for match in [pattern.match(name)] if match]
+    return [name for number, name in sorted(numbered)]
+
+
+def apply_correction(frame, dark, gain):
+    """Return (frame - dark) * gain, cast back to frame's dtype"""
+    frame = np.asarray(frame)
+    corrected = (frame - dark) * gain
+    if frame.dtype.kind in 'ui':
+        limits = np.iinfo(frame.dtype)
+        corrected = np.clip(np.rint(corrected), limits.min, limits.max)
+    return corrected.astype(frame.dtype)
+
+
+class LazyStack:
+    """A sequence of equally-shaped HDF5 datasets, indexed like one array
+
+    The first axis is time (one dataset per reading). Indexing only reads the
+    datasets and the parts of them that were asked for. Uncompressed,
+    contiguous datasets (which is how nplab writes images and spectra) are
+    memory-mapped rather than read through h5py.
+
+    If correction is a (dark, gain) pair of per-pixel arrays, each reading is
+    returned as (reading - dark) * gain, cast back to the stored dtype.
+    """
+    def __init__(self, datasets, correction=None):
+        self.datasets = datasets
+        self.correction = correction
+        if datasets:
+            self.shape = (len(datasets),) + datasets[0].shape
+            self.dtype = datasets[0].dtype
+        else:
+            self.shape = (0,)
+            self.dtype = np.dtype(float)
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return len(self.datasets)
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        if index and index[0] is Ellipsis:
+            time_index, rest = slice(None), index
+        elif index:
+            time_index, rest = index[0], index[1:]
+        else:
+            time_index, rest = slice(None), ()
+
+        if isinstance(time_index, (int, np.integer)):
+            return self._read(time_index, rest)
+        indices = np.arange(len(self))[time_index]
+        if len(indices) == 0:
+            return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+        return np.stack([self._read(i, rest) for i in indices])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def _read(self, i, rest):
+        dataset = self.datasets[i]
+        offset = dataset.id.get_offset()
+        if offset is not None and dataset.chunks is None and dataset.compression is None:
+            array = np.memmap(dataset.file.filename, mode='r', dtype=dataset.dtype,
+                              shape=dataset.shape, offset=offset)
+            reading = np.array(array[rest])
+        else:
+            reading = dataset[rest] if rest else dataset[()]
+        if self.correction is None:
+            return reading
+        dark, gain = self.correction
+        return apply_correction(reading, dark[rest], gain[rest])
+
+    def attrs(self, name, default=None):
+        """Return attribute name of every dataset, without reading any data"""
+        return [dataset.attrs.get(name, default) for dataset in self.datasets]
+
+
+def montage(thumbnails, columns=10):
+    """Tile a time x H x W (x channels) array of thumbnails into one image"""
+    thumbnails = np.asarray(thumbnails)
+    count, height, width = thumbnails.shape[:3]
+    rows = -(-count // columns)
+    tiled = np.zeros((rows * height, columns * width) + thumbnails.shape[3:], dtype=thumbnails.dtype)
+    for i, thumbnail in enumerate(thumbnails):
+        row, column = divmod(i, columns)
+        tiled[row * height:(row + 1) * height, column * width:(column + 1) * width] = thumbnail
+    return tiled
+
+
+class BioFuMRun:
+    """One run of a BioFuM datafile, presented as lazily indexed arrays
+
+    A run is numbered by its images_N group. The experiment writes its other
+    groups (spectra_N, metrics_N...) beside that, but nplab numbers each
+    prefix separately, so see group() for how they're matched up.
+
+    frames is time x H x W (x channels) and spectra is time x wavelength.
+    Other groups the experiment writes per run (metrics, drift, intervals,
+    analysis) are available through group().
+
+    thumbnails is a single dataset holding a small copy of every frame, so
+    browsing a run needn't touch the frames at all, and thumbnail_iterations
+    says which frame each one is of. pyramid() gives the intermediate sizes.
+    Both are colour-corrected whatever the calibration mode, like
+    corrected_frames.
+
+    If the run was taken with calibration_mode 'read', frames are stored raw
+    and corrected_frames applies the stored colour calibration as they are
+    read. Otherwise corrected_frames is just frames. correct() does the same
+    for anything else frame-shaped, like z-stack planes or fused images.
+    """
+    def __init__(self, path, run=0):
+        self.file = h5py.File(path, 'r')
+        self.folder = data_folder(self.file)
+        self.run = run
+        if f'images_{run}' not in self.folder:
+            self.file.close()
+            raise KeyError(f'No run {run} in {path}')
+        self._groups = {}  # prefix -> this run's group, found when first needed
+        image_datasets = self._numbered_datasets('images', 'image')
+        self.frames = LazyStack(image_datasets)
+        self.spectra = LazyStack(self._numbered_datasets('spectra', 'spectrum'))
+        self.correction = self._read_correction()
+        self._pyramids = None  # Frame index -> pyramid group, read when first needed
+        self.corrected_frames = (self.frames if self.correction is None
+                                 else LazyStack(image_datasets, self.correction))
+
+    def _numbered_datasets(self, group_prefix, dataset_prefix):
+        group = self.group(group_prefix)
+        if group is None:
+            return []
+        return [group[name] for name in numbered_names(group, dataset_prefix)]
+
+    def _read_correction(self):
+        """Return the (dark, gain) arrays to correct frames with, if they need it"""
+        calibration = self.group('calibration')
+        if calibration is None or calibration.attrs.get('mode') != 'read' or 'dark' not in calibration:
+            return None
+        if calibration.attrs.get('flat_field', True):
+            return calibration['dark'][()], calibration['gain'][()]
+        shape = calibration['dark'].shape
+        return (np.broadcast_to(calibration['channel_darks'][()].reshape(shape[2:]), shape),
+                np.broadcast_to(calibration['channel_gains'][()].reshape(shape[2:]), shape))
+
+    def correct(self, frames):
+        """Apply the run's stored calibration to a frame, or a stack of them, if it needs it
+
+        Fused z-stacks can be corrected after fusion, since each of their
+        pixels comes unchanged from one plane.
+        """
+        if self.correction is None:
+            return np.asarray(frames)
+        return apply_correction(frames, *self.correction)
+
+    @property
+    def thumbnails(self):
+        """The run's thumbnails (time x h x w x channels), or None if it has none"""
+        previews = self.group('previews')
+        return None if previews is None else previews.get('thumbnails')
+
+    @property
+    def thumbnail_iterations(self):
+        """The frame index of each thumbnail, or None if the run has none
+
+        A frame whose preview failed has no thumbnail, so these can skip.
+        """
+        previews = self.group('previews')
+        if previews is None or 'thumbnail_iteration' not in previews:
+            return None
+        return previews['thumbnail_iteration'][()]
+
+    def pyramid(self, index, level):
+        """Return frame index downsampled by 2**level (level 0 is the frame itself)
+
+        Frames already no bigger than a thumbnail have no other levels.
+        """
+        if level == 0:
+            return self.corrected_frames[index]
+        if self._pyramids is None:
+            previews = self.group('previews')
+            self._pyramids = {} if previews is None else {
+                int(previews[name].attrs['iteration']): previews[name]
+                for name in numbered_names(previews, 'pyramid')}
+        if index not in self._pyramids:
+            raise IndexError(f'No pyramid saved for frame {index}')
+        if f'level_{level}' not in self._pyramids[index]:
+            raise IndexError(f'No level {level} saved for frame {index}')
+        return self._pyramids[index][f'level_{level}'][()]
+
+    @staticmethod
+    def runs(path):
+        """Return the run numbers present in a datafile"""
+        with h5py.File(path, 'r') as f:
+            return [int(name.split('_')[-1]) for name in numbered_names(data_folder(f), 'images')]
+
+    def group(self, prefix):
+        """Return this run's prefix_N group, or None if it wasn't written
+
+        A run creates all its groups together when it starts, but N only
+        matches the run number if every earlier run created every group. So
+        each prefix_N is matched to the images group created nearest in time
+        to it, and this returns the nearest of those matched to this run.
+        Without creation timestamps, it falls back to the same N.
+        """
+        if prefix not in self._groups:
+            self._groups[prefix] = self._find_group(prefix)
+        return self._groups[prefix]
+
+    def _find_group(self, prefix):
+        runs = {int(name.split('_')[-1]): creation_time(self.folder[name])
+                for name in numbered_names(self.folder, 'images')}
+        candidates = {name: creation_time(self.folder[name])
+                      for name in numbered_names(self.folder, prefix)}
+        if np.isnan(list(runs.values()) + list(candidates.values())).any():
+            return self.folder.get(f'{prefix}_{self.run}')
+        best = None
+        for name, created in candidates.items():
+            nearest = min(runs, key=lambda run: abs(runs[run] - created))
+            distance = abs(runs[self.run] - created)
+            if nearest == self.run and (best is None or distance < best[0]):
+                best = (distance, name)
+        return None if best is None else self.folder[best[1]]
+
+    @property
+    def wavelengths(self):
+        if len(self.spectra) == 0:
+            return None
+        wavelengths = self.spectra.datasets[0].attrs.get('wavelengths')
+        return None if wavelengths is None else np.asarray(wavelengths)
+
+    @property
+    def frame_times(self):
+        """Creation time of each frame, as a POSIX timestamp"""
+        return np.array([creation_time(dataset) for dataset in self.frames.datasets])
+
+    @property
+    def spectrum_times(self):
+        """Creation time of each spectrum, as a POSIX timestamp"""
+        return np.array([creation_time(dataset) for dataset in self.spectra.datasets])
+
+    def export(self, path, chunk_length=16, log=print):
+        """Stream this run into a chunked Zarr store at path
+
+        Readings are copied chunk_length at a time, so memory use stays at a
+        few chunks however long the run is.
+        """
+        try:
+            import zarr
+        except ImportError:
+            raise ImportError('Exporting needs the zarr package (pip install zarr)')
+        store = zarr.open_group(path, mode='w')
+        store.attrs['source'] = self.file.filename
+        store.attrs['run'] = self.run
+
+        def write_array(name, data):
+            array = store.zeros(name=name, shape=data.shape, dtype=data.dtype)
+            array[...] = data
+        for name, stack, times in (('frames', self.corrected_frames, self.frame_times),
+                                   ('spectra', self.spectra, self.spectrum_times)):
+            if len(stack) == 0:
+                continue
+            array = store.zeros(name=name, shape=stack.shape, dtype=stack.dtype,
+                                chunks=(chunk_length,) + stack.shape[1:])
+            for start in range(0, len(stack), chunk_length):
+                array[start:start + chunk_length] = stack[start:start + chunk_length]
+                log(f'{name}: {min(start + chunk_length, len(stack))}/{len(stack)}')
+            write_array(f'{name}_times', times)
+        if self.wavelengths is not None:
+            write_array('wavelengths', self.wavelengths)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect or export a BioFuM datafile')
+    parser.add_argument('datafile')
+    parser.add_argument('--run', type=int, default=None,
+                        help='Run number (default: list the runs)')
+    parser.add_argument('--export', metavar='PATH',
+                        help='Export the run to a Zarr store at PATH')
+    parser.add_argument('--chunk-length', type=int, default=16)
+    parser.add_argument('--montage', metavar='PATH',
+                        help="Save a montage of the run's thumbnails as an image at PATH")
+    parser.add_argument('--columns', type=int, default=10, help='Thumbnails per montage row')
+    args = parser.parse_args()
+
+    if args.run is None:
+        for run_number in BioFuMRun.runs(args.datafile):
+            with BioFuMRun(args.datafile, run_number) as run:
+                print(f'Run {run_number}: frames {run.frames.shape}, spectra {run.spectra.shape}')
+        sys.exit()
+
+    with BioFuMRun(args.datafile, args.run) as run:
+        print(f'Frames: {run.frames.shape} {run.frames.dtype}')
+        print(f'Spectra: {run.spectra.shape} {run.spectra.dtype}')
+        if args.montage:
+            if run.thumbnails is None:
+                print('This run has no thumbnails')
+                sys.exit(1)
+            try:
+                from PIL import Image
+            except ImportError:
+                print('Saving a montage needs the Pillow package (pip install pillow)')
+                sys.exit(1)
+            Image.fromarray(montage(run.thumbnails[()], args.columns)).save(args.montage)
+        if args.export:
+            try:
+                run.export(args.export, args.chunk_length)
+            except ImportError as e:
+                print(e)
+                sys.exit(1)
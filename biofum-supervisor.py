@@ -0,0 +1,358 @@
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import argparse
+import threading
+import traceback
+import importlib.util
+import multiprocessing
+import numpy as np
+from nplab.datafile import DataFile
+
+
+def load_experiment_module():
+    """Import biofum-experiment.py, whose name isn't a valid module name
+
+    It's registered in sys.modules so that functions from it (like the z-stack
+    fusion) can be unpickled in worker processes, which run this script again.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'biofum-experiment.py')
+    spec = importlib.util.spec_from_file_location('biofum_experiment', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['biofum_experiment'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+biofum = load_experiment_module()
+
+
+def message_size(message):
+    """Bytes of array data in a write message, which is what a rig's budget counts"""
+    size = 0
+    for part in message:
+        if isinstance(part, np.ndarray):
+            size += part.nbytes
+        elif isinstance(part, dict):
+            size += sum(np.asarray(value).nbytes for value in part.values())
+    return size
+
+
+class WriteBudget:
+    """Limits how many bytes of writes a rig can have waiting for the writer
+
+    Rigs each have their own, so one rig's big writes (raw z-stacks, say)
+    only hold that rig up. A write bigger than the whole budget still goes,
+    once nothing else from the rig is waiting.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.queued = multiprocessing.Value('q', 0, lock=False)
+        self.condition = multiprocessing.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            self.condition.wait_for(lambda: self.queued.value == 0
+                                    or self.queued.value + size <= self.max_bytes)
+            self.queued.value += size
+
+    def release(self, size):
+        with self.condition:
+            self.queued.value -= size
+            self.condition.notify_all()
+
+
+class RemoteAttrs:
+    """Stands in for a group's attrs, forwarding assignments to the writer"""
+    def __init__(self, group):
+        self.group = group
+
+    def __setitem__(self, key, value):
+        self.group.send('attrs', key, value)
+
+
+class RemoteGroup:
+    """Stands in for a datafile group in a rig process
+
+    Supports the parts of nplab's Group that BioFuMExperiment writes with.
+    Every write is put on the writer service's queue, within the rig's
+    WriteBudget, so a rig waits rather than piling up data if the writer
+    falls behind.
+    """
+    def __init__(self, writes, budget, rig, handle=0):
+        self.writes = writes
+        self.budget = budget
+        self.rig = rig
+        self.handle = handle
+        self.attrs = RemoteAttrs(self)
+        self._next_handle = [handle + 1]  # Shared with child groups, so handles are unique per rig
+
+    def send(self, kind, *args):
+        message = (kind, self.rig, self.handle) + args
+        self.budget.acquire(message_size(message))
+        self.writes.put(message)
+
+    def create_group(self, name, *args, **kwargs):
+        group = RemoteGroup(self.writes, self.budget, self.rig, self._next_handle[0])
+        group._next_handle = self._next_handle
+        self._next_handle[0] += 1
+        self.send('group', group.handle, name)
+        return group
+
+    def create_dataset(self, name, data=None, attrs=None, *args, **kwargs):
+        dataset_attrs = dict(getattr(data, 'attrs', {}))
+        dataset_attrs.update(attrs or {})
+        self.send('dataset', name, np.asarray(data), dataset_attrs)
+
+    def append_dataset(self, name, value, dtype=None):
+        self.send('append', name, np.asarray(value), dtype)
+
+
+def run_rig(config, writes, budget, statuses, stop_event):
+    """Run one rig's experiment, with all its data going to the writer service"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C goes to the supervisor, which stops us
+    name = config['name']
+
+    def report(**status):
+        statuses.put(('rig', name, dict(status, time=time.time())))
+
+    report(state='starting')
+    # Patched on the class, which this process only makes one of, so that
+    # messages logged while the experiment is created go to the writer too
+    root = RemoteGroup(writes, budget, name)
+    biofum.BioFuMExperiment.create_data_group = staticmethod(root.create_group)
+    try:
+        experiment = biofum.BioFuMExperiment(**config.get('devices', {}))
+        for setting, value in config.get('settings', {}).items():
+            setattr(experiment, setting, value)
+    except Exception as e:
+        report(state='error', error=f'Error creating BioFuMExperiment: {str(e)}')
+        return
+
+    # save_metrics is called once per iteration, so report progress from there
+    save_metrics = experiment.save_metrics
+
+    def reporting_save_metrics(metrics, iteration, iteration_start):
+        save_metrics(metrics, iteration, iteration_start)
+        report(state='running', iteration=iteration, iteration_start=iteration_start,
+               spans=dict(experiment.metrics.spans))
+    experiment.save_metrics = reporting_save_metrics
+
+    def stop_when_asked():
+        stop_event.wait()
+        experiment.stop()
+    threading.Thread(target=stop_when_asked, daemon=True).start()
+
+    report(state='running')
+    try:
+        experiment.run()
+    except Exception as e:
+        report(state='error', error=str(e))
+    else:
+        report(state='stopped')
+
+
+def run_writer(data_directory, writes, budgets, statuses, flush_period=1):
+    """Write every rig's data into its own datafile until a None arrives
+
+    Each message is taken off its rig's WriteBudget once it's been written.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Keep writing until the supervisor sends None
+    files = {}
+    groups = {}  # (rig, handle) -> Group
+    stats = {'messages': 0, 'bytes': 0, 'rig_bytes': {}, 'errors': 0}
+
+    def flush_and_report():
+        for datafile in files.values():
+            datafile.flush()
+        statuses.put(('writer', None, dict(stats, rig_bytes=dict(stats['rig_bytes']),
+                                           time=time.time())))
+
+    last_flush = time.time()
+    while True:
+        try:
+            message = writes.get(timeout=flush_period)
+        except queue.Empty:
+            message = ()
+        if message is None:
+            break
+        if message:
+            kind, rig, handle = message[:3]
+            try:
+                if rig not in files:
+                    files[rig] = DataFile(os.path.join(data_directory, f'{rig}.h5'), 'a')
+                    groups[(rig, 0)] = files[rig].require_group('BioFuMExperiment')
+                group = groups[(rig, handle)]
+                if kind == 'group':
+                    new_handle, name = message[3:]
+                    groups[(rig, new_handle)] = group.create_group(name)
+                elif kind == 'attrs':
+                    key, value = message[3:]
+                    group.attrs[key] = value
+                elif kind == 'dataset':
+                    name, data, attrs = message[3:]
+                    group.create_dataset(name, data=data, attrs=attrs, autoflush=False)
+                    stats['bytes'] += data.nbytes
+                    stats['rig_bytes'][rig] = stats['rig_bytes'].get(rig, 0) + data.nbytes
+                elif kind == 'append':
+                    name, value, dtype = message[3:]
+                    group.append_dataset(name, value, dtype=dtype)
+                stats['messages'] += 1
+            except Exception as e:
+                stats['errors'] += 1
+                statuses.put(('writer_error', rig, f'{kind}: {str(e)}'))
+            finally:
+                budgets[rig].release(message_size(message))
+
+        if time.time() - last_flush > flush_period:
+            flush_and_report()
+            last_flush = time.time()
+    flush_and_report()
+    for datafile in files.values():
+        datafile.close()
+
+
+class Supervisor:
+    """Runs one BioFuMExperiment per rig, each in its own process
+
+    Each rig's config is a dict with a 'name', the 'devices' to pass to
+    BioFuMExperiment (com_name, camera_number, spectrometer_index,
+    reading_interval) and optionally 'settings' to set on it. Data from every
+    rig goes through one writer process into data_directory/<name>.h5, and
+    each rig can have up to buffer_bytes waiting to be written.
+    """
+    def __init__(self, rigs, data_directory, buffer_bytes=256 * 2**20):
+        self.rigs = rigs
+        self.data_directory = data_directory
+        self.writes = multiprocessing.Queue()
+        self.budgets = {rig['name']: WriteBudget(buffer_bytes) for rig in rigs}
+        self.statuses = multiprocessing.Queue()
+        self.stop_event = multiprocessing.Event()
+        self.writer = None
+        self.rig_processes = {}
+        self.rig_status = {rig['name']: {'state': 'not started'} for rig in rigs}
+        self.rig_history = {rig['name']: [] for rig in rigs}  # Iteration start times
+        self.writer_status = {}
+        self.writer_errors = []
+
+    def start(self):
+        os.makedirs(self.data_directory, exist_ok=True)
+        self.writer = multiprocessing.Process(
+            target=run_writer, args=(self.data_directory, self.writes, self.budgets,
+                                     self.statuses),
+            name='biofum-writer')
+        self.writer.start()
+        for rig in self.rigs:
+            process = multiprocessing.Process(
+                target=run_rig, args=(rig, self.writes, self.budgets[rig['name']],
+                                      self.statuses, self.stop_event),
+                name=f"biofum-{rig['name']}")
+            process.start()
+            self.rig_processes[rig['name']] = process
+
+    def stop(self, timeout=None):
+        """Stop every rig, then let the writer finish what's queued and close the files
+
+        Statuses are read while waiting: a process can't exit until what it
+        has put on a queue has been taken off.
+        """
+        self.stop_event.set()
+        for process in self.rig_processes.values():
+            self.join_draining_statuses(process, timeout)
+        self.writes.put(None)
+        self.join_draining_statuses(self.writer, timeout)
+        self.update_status()
+
+    def join_draining_statuses(self, process, timeout=None, poll_period=0.1):
+        deadline = None if timeout is None else time.time() + timeout
+        while process.is_alive() and (deadline is None or time.time() < deadline):
+            self.update_status()
+            process.join(poll_period)
+
+    def update_status(self):
+        while True:
+            try:
+                kind, rig, status = self.statuses.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'rig':
+                self.rig_status[rig].update(status)
+                if 'iteration_start' in status:
+                    self.rig_history[rig] = (self.rig_history[rig] + [status['iteration_start']])[-100:]
+            elif kind == 'writer':
+                self.writer_status = status
+            elif kind == 'writer_error':
+                self.writer_errors = (self.writer_errors + [(rig, status)])[-100:]
+
+    def health(self):
+        """Return the state and throughput of every rig and of the writer"""
+        self.update_status()
+        rigs = {}
+        for name, process in self.rig_processes.items():
+            status = dict(self.rig_status[name])
+            status['alive'] = process.is_alive()
+            starts = self.rig_history[name]
+            if len(starts) > 1:
+                status['iterations_per_hour'] = 3600 * (len(starts) - 1) / (starts[-1] - starts[0])
+            status['bytes_written'] = self.writer_status.get('rig_bytes', {}).get(name, 0)
+            status['bytes_queued'] = self.budgets[name].queued.value
+            rigs[name] = status
+        try:
+            queue_depth = self.writes.qsize()
+        except NotImplementedError:  # Not available on macOS
+            queue_depth = None
+        writer = dict(self.writer_status,
+                      alive=self.writer is not None and self.writer.is_alive(),
+                      queue_depth=queue_depth,
+                      recent_errors=list(self.writer_errors))
+        return {'rigs': rigs, 'writer': writer}
+
+
+def print_health(health):
+    for name, status in health['rigs'].items():
+        line = f"{name}: {status.get('state')}"
+        if 'iteration' in status:
+            line += f", iteration {status['iteration']}"
+        if 'iterations_per_hour' in status:
+            line += f", {status['iterations_per_hour']:.1f} iterations/hour"
+        line += f", {status['bytes_written'] / 1e6:.1f} MB written"
+        line += f", {status['bytes_queued'] / 1e6:.1f} MB queued"
+        if not status['alive']:
+            line += ' (process ended)'
+        if 'error' in status:
+            line += f", error: {status['error']}"
+        print(line)
+    writer = health['writer']
+    print(f"writer: {'alive' if writer['alive'] else 'ended'}, "
+          f"{writer.get('bytes', 0) / 1e6:.1f} MB, queue depth {writer['queue_depth']}, "
+          f"{writer.get('errors', 0)} errors")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a BioFuMExperiment on each of several rigs')
+    parser.add_argument('config', help='JSON file with a list of rig configs (see Supervisor)')
+    parser.add_argument('data_directory', help='Each rig writes to <data_directory>/<name>.h5')
+    parser.add_argument('--buffer-mb', type=float, default=256,
+                        help='MB of writes each rig can have waiting for the writer before it blocks')
+    parser.add_argument('--report-interval', type=float, default=60, help='seconds')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        rigs = json.load(f)
+
+    supervisor = Supervisor(rigs, args.data_directory, int(args.buffer_mb * 2**20))
+    supervisor.start()
+    try:
+        while any(process.is_alive() for process in supervisor.rig_processes.values()):
+            time.sleep(args.report_interval)
+            print_health(supervisor.health())
+    except KeyboardInterrupt:
+        print('Stopping rigs')
+    except Exception:
+        traceback.print_exc()
+    finally:
+        supervisor.stop()
+        print_health(supervisor.health())
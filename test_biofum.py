@@ -0,0 +1,204 @@
+"""Checks of the analysis code that runs without hardware (run with pytest)
+
+The test-*.py scripts exercise the devices themselves. These load
+biofum-experiment.py and biofum-reader.py directly, since their names aren't
+valid module names. The experiment needs nplab to import, so its tests are
+skipped without it.
+"""
+import os
+import importlib.util
+import h5py
+import numpy as np
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_module(filename, name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(here, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope='module')
+def biofum():
+    pytest.importorskip('nplab')
+    return load_module('biofum-experiment.py', 'biofum_experiment')
+
+
+@pytest.fixture(scope='module')
+def reader():
+    return load_module('biofum-reader.py', 'biofum_reader')
+
+
+def textured_image(shape=(128, 128), seed=0):
+    rng = np.random.default_rng(seed)
+    image = rng.random(shape)
+    # Smooth a little, so the image has structure at more than one scale
+    return (image + np.roll(image, 1, axis=0) + np.roll(image, 1, axis=1)) / 3
+
+
+def test_estimate_shift_finds_known_shift(biofum):
+    reference = textured_image()
+    shifted = np.roll(reference, (12, -8), axis=(0, 1))
+    shift, peak = biofum.estimate_shift(reference, shifted)
+    np.testing.assert_allclose(shift, [12, -8], atol=0.5)
+    assert peak > 0.5
+
+
+def test_estimate_shift_weak_peak_for_unrelated_images(biofum):
+    shift, peak = biofum.estimate_shift(textured_image(seed=0), textured_image(seed=1))
+    assert peak < 0.2
+
+
+def test_box_blur_matches_direct_mean(biofum):
+    image = textured_image((20, 30))
+    blurred = biofum.box_blur(image, 5)
+    assert blurred.shape == image.shape
+    np.testing.assert_allclose(blurred[10, 15], image[8:13, 13:18].mean())
+
+
+def test_fuse_stack_takes_each_pixel_from_sharpest_plane(biofum):
+    sharp = (textured_image((64, 64)) * 255).astype(np.uint8)
+    blurred = biofum.box_blur(sharp.astype(float), 7).astype(np.uint8)
+    left = np.concatenate([sharp[:, :32], blurred[:, 32:]], axis=1)
+    right = np.concatenate([blurred[:, :32], sharp[:, 32:]], axis=1)
+    fused, depth = biofum.fuse_stack(np.stack([left, right]))
+    assert fused.dtype == np.uint8
+    assert (depth[8:-8, 4:24] == 0).all()
+    assert (depth[8:-8, 40:60] == 1).all()
+    np.testing.assert_array_equal(fused[8:-8, 4:24], sharp[8:-8, 4:24])
+    np.testing.assert_array_equal(fused[8:-8, 40:60], sharp[8:-8, 40:60])
+
+
+@pytest.fixture
+def calibration(biofum):
+    columns = np.arange(24)[None, :]
+    illumination = 0.5 + 0.5 * columns / 23  # Brighter towards the right
+    dark = np.full((16, 24, 3), 10.0)
+    flat = np.rint(dark + illumination[..., None] * np.array([180.0, 120.0, 60.0]))  # Tinted
+    return biofum.ColourCalibration(dark, flat), dark, flat
+
+
+def test_flat_reference_corrects_to_neutral_grey(calibration):
+    colour_calibration, dark, flat = calibration
+    corrected = colour_calibration.apply(flat.astype(np.uint8))
+    assert corrected.dtype == np.uint8
+    assert np.ptp(corrected) <= 1
+
+
+def test_lookup_tables_match_arithmetic(calibration):
+    colour_calibration, dark, flat = calibration
+    frame = np.random.default_rng(0).integers(0, 256, dark.shape, dtype=np.uint8)
+    looked_up = colour_calibration.apply(frame, flat_field=False)
+    calculated = colour_calibration.apply(frame.astype(np.int32), flat_field=False)
+    np.testing.assert_allclose(looked_up, np.clip(calculated, 0, 255), atol=1)
+
+
+def test_spectrum_analyser_bands_ratios_and_peak(biofum):
+    wavelengths = np.linspace(400, 700, 301)
+    spectrum = np.exp(-0.5 * ((wavelengths - 550) / 10) ** 2)
+    analyser = biofum.SpectrumAnalyser(wavelengths, bands=[(400, 700)],
+                                       ratios=[(550, 450)], peak_range=(500, 600))
+    row = analyser.update(spectrum, timestamp=1.0)
+    band, ratio, peak_wavelength, peak_height = row
+    np.testing.assert_allclose(band, 10 * np.sqrt(2 * np.pi), rtol=1e-3)
+    assert ratio > 1e3
+    assert peak_wavelength == 550 and peak_height == 1
+    times, values = analyser.history()
+    np.testing.assert_array_equal(times, [1.0])
+    np.testing.assert_array_equal(values, [row])
+
+
+def test_spectrum_analyser_history_grows(biofum):
+    analyser = biofum.SpectrumAnalyser(np.arange(10.0))
+    for i in range(100):
+        analyser.update(np.arange(10.0), timestamp=i)
+    times, values = analyser.history()
+    np.testing.assert_array_equal(times, np.arange(100))
+    assert values.shape == (100, 2)
+
+
+def test_spectrum_analyser_peak_range_outside_spectrum(biofum):
+    analyser = biofum.SpectrumAnalyser(np.linspace(400, 700, 31), peak_range=(800, 900))
+    assert analyser.peak_range is None
+    peak_wavelength, peak_height = analyser.update(np.arange(31.0), timestamp=0)
+    assert peak_wavelength == 700 and peak_height == 30
+
+
+def test_background_log_collapses_repeats_in_order(biofum):
+    batches = []
+    log = biofum.BackgroundLog(batches.append)
+    log.put('first')
+    for _ in range(5):
+        log.put('again')
+    log.put('last', 'warn')
+    assert log.flush()
+    messages = [(level, message) for batch in batches for _, level, message in batch]
+    assert messages == [('info', 'first'), ('info', 'again'),
+                        ('info', '(last message repeated 4 times)'), ('warn', 'last')]
+
+
+def test_background_log_flush_writes_everything_put(biofum):
+    batches = []
+    log = biofum.BackgroundLog(batches.append, flush_interval=60)
+    for i in range(50):
+        log.put(f'message {i}')
+    assert log.flush()
+    messages = [message for batch in batches for _, _, message in batch]
+    assert messages == [f'message {i}' for i in range(50)]
+
+
+def test_background_log_limits_recurring_messages_only(biofum):
+    batches = []
+    log = biofum.BackgroundLog(batches.append, rate_limit=1, flush_interval=60)
+    for i in range(20):
+        log.put('flapping')
+        log.put(f'status {i}')
+    log.put('failed', 'error')
+    assert log.flush()
+    messages = [message for batch in batches for _, _, message in batch]
+    assert messages.count('flapping') == 1
+    assert all(f'status {i}' in messages for i in range(20))
+    assert 'failed' in messages
+    assert 'Suppressed 19 log messages that kept recurring' in messages
+
+
+@pytest.fixture
+def run_file(tmp_path):
+    path = str(tmp_path / 'run.h5')
+    with h5py.File(path, 'w') as f:
+        folder = f.create_group('BioFuMExperiment')
+        images = folder.create_group('images_0')
+        spectra = folder.create_group('spectra_0')
+        for i in range(5):
+            images.create_dataset(f'image_{i}', data=np.full((6, 8, 3), 20 * i, dtype=np.uint8))
+            spectra.create_dataset(f'spectrum_{i}', data=np.arange(10.0) + i)
+        calibration = folder.create_group('calibration_0')
+        calibration.attrs['mode'] = 'read'
+        calibration.attrs['flat_field'] = True
+        calibration['dark'] = np.full((6, 8, 3), 10, dtype=np.float32)
+        calibration['gain'] = np.full((6, 8, 3), 2, dtype=np.float32)
+    return path
+
+
+def test_lazy_stack_slice_shapes(reader, run_file):
+    with reader.BioFuMRun(run_file) as run:
+        assert run.frames.shape == (5, 6, 8, 3)
+        assert run.frames[2].shape == (6, 8, 3)
+        assert run.frames[1:4].shape == (3, 6, 8, 3)
+        assert run.frames[::2, 1:3, :, 0].shape == (3, 2, 8)
+        assert run.frames[..., 1].shape == (5, 6, 8)
+        assert run.frames[5:].shape == (0, 6, 8, 3)
+        np.testing.assert_array_equal(run.frames[3], 60)
+        np.testing.assert_array_equal(run.spectra[-1], np.arange(10.0) + 4)
+
+
+def test_lazy_stack_applies_stored_correction(reader, run_file):
+    with reader.BioFuMRun(run_file) as run:
+        corrected = run.corrected_frames[:, 0, 0, 0]
+        np.testing.assert_array_equal(corrected, [0, 20, 60, 100, 140])
+        assert run.corrected_frames[1:3, 2:4].shape == (2, 2, 8, 3)
+        assert run.corrected_frames.dtype == np.uint8
+        np.testing.assert_array_equal(run.correct(run.frames[4])[0, 0], 140)